@@ -1,35 +1,87 @@
-import importlib
-import json
+import argparse
+import concurrent.futures
+import glob
+import hashlib
 import os.path
 import re
+import shlex
+import shutil
 import subprocess
 import sys
+import threading
+import urllib.parse
 
 import requests
-import urllib3
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 LOADERS: list = ['Vanilla', 'Fabric', 'Forge', 'Quilt', 'Carpet 1.12', 'Paper']
-PYTHON_CMD: str = ''
+IS_WIN: bool = sys.platform == 'win32'
+IS_LINUX: bool = sys.platform == 'linux'
 SERVER_JAR: str = ''
+MC_VERSION: tuple = (0, 0)
+# Set by --yes, questions not answered with a flag take their default instead of waiting for input
+ASSUME_DEFAULTS: bool = False
 MOJANG_VERSIONS_MANIFEST: str = 'https://launchermeta.mojang.com/mc/game/version_manifest_v2.json'
 PAPER_URL: str = 'https://api.papermc.io/v2/projects/paper/'
 FORGE_URL: str = 'https://files.minecraftforge.net/net/minecraftforge/forge/promotions_slim.json'
 FORGE_URL2: str = 'https://maven.minecraftforge.net/net/minecraftforge/forge/'
 FABRIC_URL: str = 'https://maven.fabricmc.net/net/fabricmc/fabric-installer/0.11.0/fabric-installer-0.11.0.jar'
 CARPET_112: str = 'https://gitlab.com/Xcom/carpetinstaller/uploads/24d0753d3f9a228e9b8bbd46ce672dbe/carpetInstaller.jar'
+MCDR: str = 'mcdreforged'
 QUILT_URL = 'https://maven.quiltmc.org/repository/release/org/quiltmc/quilt-installer/latest/quilt-installer-latest.jar'
+# The XDG spec says a relative XDG_CACHE_HOME must be ignored, it would also move with the chdir into the server folder
+XDG_CACHE_HOME: str = os.environ.get('XDG_CACHE_HOME', '')
+CACHE_DIR: str = os.path.join(
+    XDG_CACHE_HOME if os.path.isabs(XDG_CACHE_HOME) else os.path.join(os.path.expanduser('~'), '.cache'), 'ams-py')
+MANIFEST_CACHE: dict = {}
+PREFETCH: dict = {}
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+# Set on Ctrl-C/EOF, background downloads stop at their next chunk and background processes are terminated
+ABORT = threading.Event()
+BACKGROUND: set = set()
+# Absolute path once created, an aborted setup removes it if nothing was written yet
+SERVER_FOLDER: str = ''
+# Menu index ('1') or loader name ('fabric') => LOADERS index
+LOADER_LOOKUP: dict = {key: index for index, value in enumerate(LOADERS) for key in (str(index + 1), value.lower())}
+YES_NO: dict = {'y': True, 'yes': True, 'n': False, 'no': False}
+NON_WORD: re.Pattern = re.compile(r'\W')
+# 1.19 or 1.19.2, used with fullmatch
+MC_VERSION_PATTERN: re.Pattern = re.compile(r'\d+(?:\.\d+){1,2}')
+TIMEOUT: int = 30
+SESSION = requests.Session()
+ADAPTER = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=3)
+SESSION.mount('https://', ADAPTER)
+SESSION.mount('http://', ADAPTER)
+
+
+def sp(args: list[str], exit_in_error=False, cwd: str | None = None, log: list | None = None):
+    # With log the output is collected instead of printed, for commands running in background
+    def drain(stream, prefix: str):
+        with stream:
+            for line in stream:
+                (print if log is None else log.append)(f'{prefix} {line.strip()}')
 
-
-def sp(args: str, exit_in_error=False):
     try:
-        with subprocess.Popen(args.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-            with process.stdout as stdout:
-                for line in iter(stdout.readline, b''):
-                    print(f'[STDOUT] {line.decode("utf-8").strip()}')
-            with process.stderr as stderr:
-                for line in iter(stderr.readline, b''):
-                    print(f'[STDERR] {line.decode("utf-8").strip()}')
+        # Text mode decodes in the io layer, bad bytes from the child are replaced instead of raising
+        # Python fds are non-inheritable anyway, skipping the close pass lets CPython use posix_spawn when it can
+        with subprocess.Popen(args, bufsize=16384, cwd=cwd, encoding='utf-8', errors='replace', close_fds=False,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+            if log is not None:
+                BACKGROUND.add(process)
+                # Started after abort() went through BACKGROUND
+                if ABORT.is_set():
+                    process.terminate()
+            # Read both pipes at the same time, a full stderr pipe would block the child while we wait on stdout
+            stderr_thread = threading.Thread(target=drain, args=(process.stderr, '[STDERR]'))
+            stderr_thread.start()
+            drain(process.stdout, '[STDOUT]')
+            stderr_thread.join()
             process.wait()
+            BACKGROUND.discard(process)
             if process.returncode != 0 and exit_in_error:
                 print('!! Something failed in subprocess execution')
                 raise SystemError
@@ -38,147 +90,267 @@ def sp(args: str, exit_in_error=False):
         sys.exit(1)
 
 
-def simple_yes_no(question: str, default_no=True) -> bool:
-    while True:
-        choose = ' [y/N]: ' if default_no else ' [Y/n]: '
-        ans = input('→ ' + question + choose).lower().strip()
-        match ans[0] if ans else ans[:1]:
-            case '':
-                return not bool(default_no)
-            case 'yes' | 'y':
-                return True
-            case 'no' | 'n':
-                return False
-            case _:
-                print(f'{ans} is an invalid answer, yes or no required')
+def url_file_name(url: str) -> str:
+    # Last path segment, a query string or fragment never ends up in the file name
+    return os.path.basename(urllib.parse.urlparse(url).path)
+
+
+def download(url: str, file_name: str):
+    # Stream the body to disk, jars can be tens of MB and don't need to be held in memory
+    with SESSION.get(url, stream=True, allow_redirects=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        # iter_content rather than response.raw, it decodes gzip and turns mid-body drops and stalls into requests errors
+        with open(file_name, 'wb') as file:
+            for chunk in response.iter_content(1 << 20):
+                if ABORT.is_set():
+                    raise requests.exceptions.RequestException(f'Download cancelled: {url}')
+                file.write(chunk)
+
+
+def file_sha1(file_name: str) -> str:
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fetch_to_cache(url: str, sha1: str = '', refresh=False) -> str:
+    # Cached copies are never revalidated, use refresh for urls that point to a moving target
+    cache_file = os.path.join(CACHE_DIR, sha1, url_file_name(url))
+    if refresh or not os.path.isfile(cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        download(url, f'{cache_file}.part')
+        # A complete but wrong body (proxy error page, truncated mirror) would otherwise be cached for good
+        if sha1 and file_sha1(f'{cache_file}.part') != sha1:
+            os.remove(f'{cache_file}.part')
+            raise requests.exceptions.RequestException(f'sha1 mismatch for {url}')
+        os.replace(f'{cache_file}.part', cache_file)
+    return cache_file
+
+
+def prefetch(url: str, refresh=False):
+    # Start the download in background, the user is still answering prompts meanwhile
+    PREFETCH[url] = EXECUTOR.submit(fetch_to_cache, url, refresh=refresh)
+
+
+def cached_download(url: str, file_name: str, sha1: str = '', refresh=False):
+    future: concurrent.futures.Future | None = PREFETCH.pop(url, None)
+    cache_file: str = future.result() if future else fetch_to_cache(url, sha1, refresh)
+    shutil.copyfile(cache_file, file_name)
+
+
+def replace_line(file_name: str, prefix: str, new_line: str):
+    # Stream into a temp file and swap it in, the original is left untouched if something fails midway
+    # The line is found by its key, so a template that adds or moves lines doesn't get the wrong line overwritten
+    found = False
+    tmp_file = f'{file_name}.tmp'
+    with open(file_name, 'r', encoding='utf-8') as src, open(tmp_file, 'w', encoding='utf-8') as dst:
+        for line in src:
+            if not found and line.startswith(prefix):
+                line, found = new_line, True
+            dst.write(line)
+    if not found:
+        os.remove(tmp_file)
+        print(f'!! "{prefix}" not found in {file_name}, edit it manually')
+        return
+    os.replace(tmp_file, file_name)
+
+
+def remove_files(*files: str):
+    # Installer leftovers, a missing or locked file is not worth failing a finished install
+    for file in files:
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            print(f'!! Could not remove {file}:\n\t{err}')
+
+
+def get_json(url: str):
+    response = SESSION.get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    return json_loads(response.content)
+
+
+def fetch_manifest() -> bytes:
+    # Keep a copy on disk and revalidate it with its ETag, an unchanged manifest comes back as an empty 304
+    manifest_file = os.path.join(CACHE_DIR, url_file_name(MOJANG_VERSIONS_MANIFEST))
+    etag_file = f'{manifest_file}.etag'
+    headers: dict = {}
+    if os.path.isfile(manifest_file) and os.path.isfile(etag_file):
+        with open(etag_file, 'r', encoding='utf-8') as file:
+            headers['If-None-Match'] = file.read().strip()
+    response = SESSION.get(MOJANG_VERSIONS_MANIFEST, headers=headers, timeout=TIMEOUT)
+    if response.status_code == 304:
+        with open(manifest_file, 'rb') as file:
+            return file.read()
+    response.raise_for_status()
+    etag: str | None = response.headers.get('ETag')
+    if etag:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(f'{manifest_file}.part', 'wb') as file:
+                file.write(response.content)
+            os.replace(f'{manifest_file}.part', manifest_file)
+            with open(etag_file, 'w', encoding='utf-8') as file:
+                file.write(etag)
+        except OSError as err:
+            print(f'!! Could not cache the version manifest:\n\t{err}')
+    return response.content
 
 
-def check_environment() -> str:
-    sp('java -version')
+def get_manifest() -> dict:
+    # Mojang manifest is shared by the latest release lookup and the vanilla loader, only fetch it once
+    if not MANIFEST_CACHE:
+        future: concurrent.futures.Future | None = PREFETCH.pop(MOJANG_VERSIONS_MANIFEST, None)
+        MANIFEST_CACHE.update(json_loads(future.result() if future else fetch_manifest()))
+    return MANIFEST_CACHE
+
+
+def get_last_release() -> str:
+    return get_manifest()['latest']['release']
+
+
+def parse_version(minecraft: str) -> tuple[int, int]:
+    # 1.18.2 => major=18, minor=2 || 1.16 => major=16, minor=0
+    tmp = minecraft.split('.')
+    return int(tmp[1]), int(tmp[2]) if len(tmp) == 3 else 0
+
+
+def ask(prompt: str, answer: str | None = None) -> str:
+    if answer is not None:
+        return answer
+    # An empty answer is what selects the default on every prompt
+    return '' if ASSUME_DEFAULTS else input(prompt)
+
+
+def simple_yes_no(question: str, default_no=True, answer: bool | None = None) -> bool:
+    if answer is not None:
+        return answer
+    if ASSUME_DEFAULTS:
+        return not default_no
+    prompt = f'→ {question}{" [y/N]: " if default_no else " [Y/n]: "}'
+    while True:
+        ans = input(prompt).lower().strip()
+        if not ans:
+            return not default_no
+        if ans in YES_NO:
+            return YES_NO[ans]
+        print(f'{ans} is an invalid answer, yes or no required')
+
+
+def check_environment():
+    # A PATH lookup is enough to know java is there, 'java -version' would boot a whole JVM just for that
+    if shutil.which('java') is None:
+        print('!! Looks like system can\'t find that program: java')
+        sys.exit(1)
     major, minor = sys.version_info.major, sys.version_info.minor
     if major < 3 or (major == 3 and minor < 10):
         print('!! Python 3.10+ is needed')
         sys.exit(0)
-    match sys.platform:
-        case 'win32':
-            return 'python'
-        case 'linux':
-            return 'python3'
-        case _:
-            print(f'!! {sys.platform} is currently not supported as OS')
-            sys.exit(0)
+    if not (IS_WIN or IS_LINUX):
+        print(f'!! {sys.platform} is currently not supported as OS')
+        sys.exit(0)
 
 
 def mk_folder(folder: str):
     try:
-        if os.path.exists(folder):
-            print(f'!! Folder "{folder}" already exists')
-            sys.exit(0)
         os.mkdir(folder)
         os.chdir(folder)
+    except FileExistsError:
+        print(f'!! Folder "{folder}" already exists')
+        sys.exit(0)
     except OSError as err:
         print(f'!! Something failed:\n\t{err}')
         sys.exit(1)
 
 
-def server_loader() -> int:
+def server_loader(option: str | None = None) -> int:
+    if option in LOADER_LOOKUP:
+        return LOADER_LOOKUP[option]
     print('→ Which loader do you want to use?')
     for key, value in enumerate(LOADERS):
         print(f' {key + 1} | {value}')
     while True:
         option: str = input('→ Select a option: ').lower().strip()
-        for key, value in enumerate(LOADERS):
-            if str(key + 1) == option or str(value).lower() == option:
-                return key
+        if option in LOADER_LOOKUP:
+            return LOADER_LOOKUP[option]
         print(f'{option} is an invalid answer, a valid index o loader name is needed')
 
 
-def vanilla_loader(minecraft: str):
+def vanilla_loader(minecraft: str, server_dir: str):
     print('> Vanilla loader setup')
-    tmp = minecraft.split('.')
-    major, minor = int(tmp[1]), int(tmp[2]) if len(tmp) == 3 else 0
+    major, minor = MC_VERSION
     is_invalid = major < 2 or (major == 2 and minor < 5)
     if is_invalid:
         print(f'!! Version {minecraft} is currently unsupported by the script')
         sys.exit(1)
-    if re.match(r'[\d.]', minecraft):
+    if MC_VERSION_PATTERN.fullmatch(minecraft):
         try:
-            http = urllib3.PoolManager()
-            resp: urllib3.response.HTTPResponse = http.request('GET', MOJANG_VERSIONS_MANIFEST)
-            versions_json: dict = json.loads(resp.data.decode('utf-8'))['versions']
-            for index, version in enumerate(versions_json):
-                if version['id'] == minecraft:
-                    url: str = version['url']
-                    resp = http.request('GET', url)
-                    version_json: dict = json.loads(resp.data.decode('utf-8'))
-                    server_url: str = version_json['downloads']['server']['url']
-                    # Download server.jar and write in disk
-                    response: requests.models.Response = requests.get(server_url, allow_redirects=True)
-                    server_file: str = list(server_url.split('/'))[6]
-                    with open(server_file, 'wb') as file:
-                        file.write(response.content)
-                    globals()['SERVER_JAR'] = server_file
-                    print('> Vanilla server download complete')
-                    break
-                if index == len(versions_json) - 1:
-                    print('!! Version not found in Mojang manifest')
-                    break
-        except (urllib3.exceptions.MaxRetryError, requests.exceptions.RequestException) as err:
+            version_urls: dict = {version['id']: version['url'] for version in get_manifest()['versions']}
+            url: str | None = version_urls.get(minecraft)
+            if url is None:
+                print('!! Version not found in Mojang manifest')
+                return
+            version_json: dict = get_json(url)
+            server_url: str = version_json['downloads']['server']['url']
+            # Download server.jar and write in disk
+            server_file: str = url_file_name(server_url)
+            cached_download(server_url, os.path.join(server_dir, server_file), version_json['downloads']['server']['sha1'])
+            globals()['SERVER_JAR'] = server_file
+            print('> Vanilla server download complete')
+        except requests.exceptions.RequestException as err:
             print(f'!! Something failed:\n\t{err}')
             sys.exit(1)
     else:
         print(f'!! Version provided: {minecraft} is invalid')
 
 
-def fabric_loader(minecraft: str):
+def fabric_loader(minecraft: str, server_dir: str):
     print('> Fabric loader setup')
     try:
-        response = requests.get(FABRIC_URL, allow_redirects=True)
-        installer: str = list(FABRIC_URL.split('/'))[7]
-        with open(installer, 'wb') as file:
-            file.write(response.content)
-        if minecraft and re.match(r'[\d.]', minecraft):
+        installer: str = url_file_name(FABRIC_URL)
+        cached_download(FABRIC_URL, os.path.join(server_dir, installer))
+        if minecraft and not MC_VERSION_PATTERN.fullmatch(minecraft):
             print(f'!! Version provided: {minecraft} is invalid')
             return
-        sp(f'java -jar {installer} server -mcversion {minecraft} -downloadMinecraft')
+        args: list = ['java', '-jar', installer, 'server']
+        if minecraft:
+            args += ['-mcversion', minecraft]
+        args.append('-downloadMinecraft')
+        sp(args, cwd=server_dir)
         globals()['SERVER_JAR'] = 'fabric-server-launch.jar'
         print('> Fabric server download complete')
-        os.remove(installer)
-    except (urllib3.exceptions.MaxRetryError, requests.exceptions.RequestException, OSError) as err:
+        remove_files(os.path.join(server_dir, installer))
+    except (requests.exceptions.RequestException, OSError) as err:
         print(f'!! Something failed:\n\t{err}')
         sys.exit(1)
 
 
-def forge_loader(minecraft: str):
-    print('> Quilt loader setup')
+def forge_loader(minecraft: str, server_dir: str):
+    print('> Forge loader setup')
     try:
-        http = urllib3.PoolManager()
-        resp: urllib3.response.HTTPResponse = http.request('GET', FORGE_URL)
-        versions_json: dict = json.loads(resp.data.decode('utf-8'))['promos']
-        for index, version_raw in enumerate(versions_json):
-            version_raw: str = version_raw.replace('-latest', '').replace('-recommended', '')
-            if version_raw == minecraft:
-                if simple_yes_no('> Do you want to use latest forge build? [latest]', default_no=False):
-                    version = f'{version_raw}-latest'
-                else:
-                    version = f'{version_raw}-recommended'
-                print(f'> Using forge: {version}')
-                build = versions_json[version]
-                version_build = f'{version_raw}-{build}'
-                server_file = f'forge-{version_build}-installer.jar'
-                server_url = f'{FORGE_URL2}{version_build}/{server_file}'
-                response = requests.get(server_url, allow_redirects=True)
-                with open(server_file, 'wb') as file:
-                    file.write(response.content)
-                sp(f'java -jar {server_file} --installServer')
-                print('> Forge server download complete')
-                os.remove(f'{server_file}.log')
-                os.remove(server_file)
-                break
-            if index == len(versions_json) - 1:
-                print('!! Version not found in Forge')
-                break
-    except (urllib3.exceptions.MaxRetryError, requests.exceptions.RequestException, OSError) as err:
+        # promos keys are '<minecraft>-latest' and, only for some versions, '<minecraft>-recommended'
+        promos: dict = get_json(FORGE_URL)['promos']
+        if f'{minecraft}-latest' not in promos:
+            print('!! Version not found in Forge')
+            return
+        if f'{minecraft}-recommended' not in promos or \
+                simple_yes_no('> Do you want to use latest forge build? [latest]', default_no=False):
+            version = f'{minecraft}-latest'
+        else:
+            version = f'{minecraft}-recommended'
+        print(f'> Using forge: {version}')
+        version_build = f'{minecraft}-{promos[version]}'
+        server_file = f'forge-{version_build}-installer.jar'
+        server_url = f'{FORGE_URL2}{version_build}/{server_file}'
+        download(server_url, os.path.join(server_dir, server_file))
+        sp(['java', '-jar', server_file, '--installServer'], cwd=server_dir)
+        print('> Forge server download complete')
+        remove_files(os.path.join(server_dir, f'{server_file}.log'), os.path.join(server_dir, server_file))
+    except (requests.exceptions.RequestException, OSError) as err:
         print(f'!! Something failed:\n\t{err}')
         sys.exit(1)
     except KeyError as err:
@@ -186,94 +358,80 @@ def forge_loader(minecraft: str):
         sys.exit(2)
 
 
-def quilt_loader(minecraft: str):
+def quilt_loader(minecraft: str, server_dir: str):
     print('> Quilt loader setup')
     try:
-        response = requests.get(QUILT_URL, allow_redirects=True)
-        installer: str = list(QUILT_URL.split('/'))[9]
-        with open(installer, 'wb') as file:
-            file.write(response.content)
-        if minecraft and re.match(r'[^\d.]', minecraft):
+        installer: str = url_file_name(QUILT_URL)
+        cached_download(QUILT_URL, os.path.join(server_dir, installer), refresh=True)
+        if minecraft and not MC_VERSION_PATTERN.fullmatch(minecraft):
             print(f'!! Version provided: {minecraft} is invalid')
             return
-        sp(f'java -jar {installer} install server {minecraft} --install-dir={os.getcwd()} --download-server')
+        sp(['java', '-jar', installer, 'install', 'server', minecraft,
+            f'--install-dir={os.path.abspath(server_dir)}', '--download-server'], cwd=server_dir)
         globals()['SERVER_JAR'] = 'quilt-server-launch.jar'
         print('> Quilt server download complete')
-        os.remove(installer)
+        remove_files(os.path.join(server_dir, installer))
     except (requests.exceptions.RequestException, OSError) as err:
         print(f'!! Something failed:\n\t{err}')
         sys.exit(1)
 
 
-def carpet112_setup():
+def carpet112_setup(server_dir: str):
     print('> Carpet 1.12 setup')
     try:
-        response = requests.get(CARPET_112, allow_redirects=True)
-        installer: str = CARPET_112.split('/')[7]
-        with open(installer, 'wb') as file:
-            file.write(response.content)
-        sp(f'java -jar {installer}')
-        os.chdir('update')
-        carpet_file: str = [file.replace('zip', 'jar') for file in os.listdir(os.getcwd()) if file.endswith('.zip')][0]
-        import shutil
-        shutil.move(carpet_file, '..')
-        os.chdir('..')
-        shutil.rmtree('update')
+        installer: str = url_file_name(CARPET_112)
+        cached_download(CARPET_112, os.path.join(server_dir, installer))
+        sp(['java', '-jar', installer], cwd=server_dir)
+        carpet_zip: str = next(glob.iglob(os.path.join(server_dir, 'update', '*.zip')))
+        carpet_file: str = f'{os.path.splitext(os.path.basename(carpet_zip))[0]}.jar'
+        os.replace(carpet_zip, os.path.join(server_dir, carpet_file))
+        shutil.rmtree(os.path.join(server_dir, 'update'))
         globals()['SERVER_JAR'] = carpet_file
         print('> Carpet 1.12 download complete')
-        os.remove(installer)
+        remove_files(os.path.join(server_dir, installer))
     except (requests.exceptions.RequestException, OSError) as err:
         print(f'!! Something failed:\n\t{err}')
         sys.exit(1)
 
 
-def paper_loader(minecraft: str):
+def paper_loader(minecraft: str, server_dir: str):
     print('> Paper loader setup')
     try:
-        http = urllib3.PoolManager()
-        resp: urllib3.response.HTTPResponse = http.request('GET', PAPER_URL)
-        versions_json: dict = json.loads(resp.data.decode('utf-8'))['versions']
-        for index, version in enumerate(versions_json):
-            if version == minecraft:
-                print('> Paper minecraft version found!')
-                temp_url = f'{PAPER_URL}versions/{minecraft}/builds/'
-                resp: urllib3.response.HTTPResponse = http.request('GET', temp_url)
-                version_json: dict = json.loads(resp.data.decode('utf-8'))
-                print(f'{version_json=}')
-                print(f'{type(version_json)=}')
-                build: str = version_json['builds'][-1]['build']
-                server_file: str = version_json['builds'][-1]['downloads']['application']['name']
-                server_url: str = f'{temp_url}{build}/downloads/{server_file}/'
-                response = requests.get(server_url, allow_redirects=True)
-                with open(server_file, 'wb') as file:
-                    file.write(response.content)
-                globals()['SERVER_JAR'] = server_file
-                print('> Paper server download complete')
-                break
-            if index == len(versions_json) - 1:
-                print('!! Version not found in PaperMC')
-                break
-    except (urllib3.exceptions.MaxRetryError, requests.exceptions.RequestException) as err:
+        # The version summary only lists build numbers, the full builds list carries every build's changes
+        response = SESSION.get(f'{PAPER_URL}versions/{minecraft}', timeout=TIMEOUT)
+        if response.status_code == 404:
+            print('!! Version not found in PaperMC')
+            return
+        response.raise_for_status()
+        print('> Paper minecraft version found!')
+        build: int = json_loads(response.content)['builds'][-1]
+        server_file = f'paper-{minecraft}-{build}.jar'
+        server_url = f'{PAPER_URL}versions/{minecraft}/builds/{build}/downloads/{server_file}'
+        # A build number never gets a different jar, so it is safe to keep in the cache
+        cached_download(server_url, os.path.join(server_dir, server_file))
+        globals()['SERVER_JAR'] = server_file
+        print('> Paper server download complete')
+    except requests.exceptions.RequestException as err:
         print(f'!! Something failed:\n\t{err}')
         sys.exit(1)
 
 
-def loader_setup(loader: int, mc: str):
+def loader_setup(loader: int, mc: str, server_dir: str = '.'):
     # _LOADERS = {'Vanilla': 0, 'Fabric': 1, 'Forge': 2, 'Quilt': 3, 'Carpet 1.12': 4, 'Paper': 5}
     try:
         match loader:
             case 0:
-                vanilla_loader(mc)
+                vanilla_loader(mc, server_dir)
             case 1:
-                fabric_loader(mc)
+                fabric_loader(mc, server_dir)
             case 2:
-                forge_loader(mc)
+                forge_loader(mc, server_dir)
             case 3:
-                quilt_loader(mc)
+                quilt_loader(mc, server_dir)
             case 4:
-                carpet112_setup()
+                carpet112_setup(server_dir)
             case 5:
-                paper_loader(mc)
+                paper_loader(mc, server_dir)
             case _:
                 raise OSError
     except OSError as err:
@@ -281,103 +439,95 @@ def loader_setup(loader: int, mc: str):
         sys.exit(1)
 
 
-def mcdr_setup(loader: int, mc: str, is_forge: bool):
+def mcdr_install() -> list:
+    log: list = ['> Update pip packages']
+    sp([sys.executable, '-m', 'pip', 'install', '--upgrade', 'pip', 'setuptools', 'wheel'], log=log)
+    log.append(f'> Installing {MCDR} package')
+    sp([sys.executable, '-m', 'pip', 'install', MCDR], log=log)
+    return log
+
+
+def mcdr_prepare():
+    import importlib.util
+    # find_spec only looks the package up, importing it would run all of mcdreforged's init code
+    if importlib.util.find_spec(MCDR) is None:
+        print(f'!! {MCDR} package is required')
+        if simple_yes_no('Do  want to autoinstall this package?', default_no=False):
+            # pip runs while the loader and version are asked, its output is shown once mcdr_setup starts
+            PREFETCH[MCDR] = EXECUTOR.submit(mcdr_install)
+
+
+def mcdr_setup(loader: int, mc: str, is_forge: bool, nickname: str | None = None):
     def start_command(jar_name: str) -> str:
         return f'java -Xms1G -Xmx2G -jar {jar_name}.jar nogui'
 
-    mcdr: str = 'mcdreforged'
+    future: concurrent.futures.Future | None = PREFETCH.pop(MCDR, None)
+    if future:
+        print(f'> Waiting for {MCDR} install to finish')
+        for line in future.result():
+            print(line)
     try:
-        importlib.import_module(mcdr)
-    except ImportError:
-        print(f'!! {mcdr} package is required')
-        if simple_yes_no('Do  want to autoinstall this package?', default_no=False):
-            print('> Update pip packages')
-            sp(f'{PYTHON_CMD} -m pip install --upgrade pip setuptools wheel')
-            print(f'> Installing {mcdr} package')
-            sp(f'{PYTHON_CMD} -m pip install {mcdr}')
-    try:
-        sp(f'{PYTHON_CMD} -m {mcdr} init')
-        os.chdir('server')
-        loader_setup(loader, mc)
-        os.chdir('..')
+        sp([sys.executable, '-m', MCDR, 'init'])
+        # MCDR runs the minecraft server from its 'server' folder
+        loader_setup(loader, mc, 'server')
         # start_command edit
         config_file = 'config.yml'
-        with open(config_file, 'r', encoding='utf-8') as file:
-            data = file.readlines()
-            if not is_forge:
-                data[19] = f'start_command: {start_command(SERVER_JAR)}\n'
-            else:
-                print(f'=== Edit {config_file}::start_command if you use linux ===')
-                data[19] = f'start_command: run.bat\n'
-        with open(config_file, 'w', encoding='utf-8') as file:
-            file.writelines(data)
+        if not is_forge:
+            replace_line(config_file, 'start_command:', f'start_command: {start_command(SERVER_JAR)}\n')
+        else:
+            print(f'=== Edit {config_file}::start_command if you use linux ===')
+            replace_line(config_file, 'start_command:', 'start_command: run.bat\n')
         # permission.yml set owner name
-        nickname: str = input('→ Do you want to set the server owner in MCDR? [Skip]: ').strip()
+        nickname = ask('→ Do you want to set the server owner in MCDR? [Skip]: ', nickname).strip()
         if nickname:
             print(f'> Nickname to set {nickname}')
-            perm_file = 'permission.yml'
-            with open(perm_file, 'r', encoding='utf-8') as file:
-                data = file.readlines()
-                data[13] = f'- {nickname}\n'
-            with open(perm_file, 'w', encoding='utf-8') as file:
-                file.writelines(data)
+            replace_line('permission.yml', 'owner:', f'owner:\n- {nickname}\n')
     except OSError as err:
         print(f'!! Something failed:\n\t{err}')
         sys.exit(1)
 
 
-def post_setup(is_mcdr: bool, mc_version: str, is_forge: bool):
+def post_setup(is_mcdr: bool, is_forge: bool, eula: bool | None = None):
     try:
-        def launch_scripts(cmd: str):
+        def launch_scripts(args: list[str]):
             print('> Creating launch scripts')
-            with open('start.bat', 'w', encoding='utf-8') as _file:
-                _file.write(f'@echo off\n{cmd}\n')
-            with open('start.sh', 'w', encoding='utf-8') as _file:
-                _file.write(f'#!\\bin\\bash\n{cmd}\n')
-            if sys.platform == 'linux':
-                sp('chmod +x start.sh')
-
+            # Written as bytes on every platform, so cmd.exe's CRLF line endings are spelled out
+            with open('start.bat', 'wb') as _file:
+                _file.write(f'@echo off\r\n{subprocess.list2cmdline(args)}\r\n'.encode())
+            # Created already executable, no need to spawn chmod afterwards
+            with open(os.open('start.sh', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755), 'wb') as _file:
+                _file.write(f'#!/bin/bash\n{shlex.join(args)}\n'.encode())
+
+        # run_args is what the launch scripts wrap, the first start runs it directly without a cmd.exe/bash in between
+        # MCDR is started by the interpreter that installed it, a python from PATH may not have it (venv, py launcher)
         if is_mcdr:
-            launch_scripts(f'{PYTHON_CMD} -m mcdreforged start')
+            run_args: list = [sys.executable, '-m', MCDR, 'start']
+            launch_scripts(run_args)
+        elif not is_forge:
+            run_args = ['java', '-Xms1G', '-Xmx2G', '-jar', SERVER_JAR, 'nogui']
+            launch_scripts(run_args)
         else:
-            if not is_forge:
-                launch_scripts(f'java -Xms1G -Xmx2G -jar {SERVER_JAR} nogui')
-            else:
-                launch_scripts('run.bat')
-        tmp = mc_version.split('.')
-        # 1.18.2 => major=18, minor=2 || 1.16 => major=16, minor=0
-        major, minor = int(tmp[1]), int(tmp[2]) if len(tmp) == 3 else 0
+            launch_scripts(['run.bat'])
+            # Forge only ships its own run scripts, those still need a shell
+            run_args = ['start.bat'] if IS_WIN else ['./start.sh']
+        major, minor = MC_VERSION
         is_invalid = major < 7 or (major == 7 and minor < 10)
         if not is_invalid:
-            if simple_yes_no('→ Do you want to start the server and set EULA=true?'):
+            if simple_yes_no('Do you want to start the server and set EULA=true?', answer=eula):
                 print('> Starting the server for the first time\nMay take some time...')
 
                 def console_thread(status: bool):
-                    with open('config.yml', 'r', encoding='utf-8') as _file:
-                        _data = _file.readlines()
-                        _data[77] = f'disable_console_thread: {"true" if status else "false"}\n'
-                    with open('config.yml', 'w', encoding='utf-8') as _file:
-                        _file.writelines(_data)
+                    # Edits the file on disk each time, MCDR rewrites config.yml during the first start
+                    key = 'disable_console_thread:'
+                    replace_line('config.yml', key, f'{key} {"true" if status else "false"}\n')
 
                 if is_mcdr:
                     console_thread(True)
-                match sys.platform:
-                    case 'win32':
-                        sp(r'start.bat')
-                    case 'linux':
-                        sp(r'./start.sh')
+                sp(run_args)
                 print('> First time server startup complete')
                 if is_mcdr:
                     console_thread(False)
-                    os.chdir('server')
-
-                with open('eula.txt', 'r', encoding='utf-8') as file:
-                    data = file.readlines()
-                    data[2] = 'eula=true\n'
-                with open('eula.txt', 'w', encoding='utf-8') as file:
-                    file.writelines(data)
-                if is_mcdr:
-                    os.chdir('..')
+                replace_line(os.path.join('server' if is_mcdr else '.', 'eula.txt'), 'eula=', 'eula=true\n')
                 print('> EULA file set to True')
         else:
             print("> Minecraft version too old, doesn't exists")
@@ -386,38 +536,97 @@ def post_setup(is_mcdr: bool, mc_version: str, is_forge: bool):
         sys.exit(1)
 
 
-def main():
+def parse_args() -> argparse.Namespace:
+    def mc_version_arg(value: str) -> str:
+        if not MC_VERSION_PATTERN.fullmatch(value):
+            raise argparse.ArgumentTypeError(f'{value} is an invalid version, something like 1.19.2 is needed')
+        return value
+
+    parser = argparse.ArgumentParser(description='Semi-automatic Minecraft server setup, '
+                                                 'questions answered with a flag are not asked')
+    parser.add_argument('--server-name', help='server folder name [mc_server]')
+    parser.add_argument('--mcdr', action=argparse.BooleanOptionalAction, help='use MCDR')
+    parser.add_argument('--loader', type=str.lower, choices=LOADER_LOOKUP, metavar='LOADER',
+                        help=f'loader name or menu index: {", ".join(LOADERS)}')
+    parser.add_argument('--mc', type=mc_version_arg, help='minecraft version [latest]')
+    parser.add_argument('--nickname', help='server owner set in MCDR')
+    parser.add_argument('--eula', action=argparse.BooleanOptionalAction,
+                        help='start the server for the first time and set EULA=true')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='take the default answer for every question without a flag, needs --loader')
+    args = parser.parse_args()
+    if args.yes and args.loader is None:
+        parser.error('--yes needs --loader, the loader has no default')
+    return args
+
+
+def main(args: argparse.Namespace):
     print('> Server script is starting up!')
+    globals()['ASSUME_DEFAULTS'] = args.yes
     # ENVIRONMENT CHECK
-    globals()['PYTHON_CMD'] = check_environment()
+    check_environment()
     # SERVER FOLDER NAME
-    server_folder: str = re.sub(r'\W', '', input('→ Server folder name [mc_server]: ').replace(' ', '_'))
+    server_folder: str = ask('→ Server folder name [mc_server]: ', args.server_name)
+    server_folder = NON_WORD.sub('', server_folder.replace(' ', '_'))
 
     server_folder = server_folder if server_folder else 'mc_server'
-    is_mcdr: bool = simple_yes_no('Do you want to use MCDR?')
-    loader: int = server_loader()
+    # Before any background work, exiting on an existing folder would otherwise wait for pip and the downloads
+    mk_folder(server_folder)
+    globals()['SERVER_FOLDER'] = os.getcwd()
+    # Needed for the latest release and the vanilla loader, fetch it while the remaining questions are answered
+    PREFETCH[MOJANG_VERSIONS_MANIFEST] = EXECUTOR.submit(fetch_manifest)
+    is_mcdr: bool = simple_yes_no('Do you want to use MCDR?', answer=args.mcdr)
+    if is_mcdr:
+        mcdr_prepare()
+    loader: int = server_loader(args.loader)
     # CHECK IF IS FORGE
     is_forge: bool = LOADERS[loader] == 'Forge'
     if is_forge:
         print('> Some features are disable due Forge loader')
+    # Installers don't depend on the minecraft version, so they can download while the remaining questions are asked
+    match LOADERS[loader]:
+        case 'Fabric':
+            prefetch(FABRIC_URL)
+        case 'Quilt':
+            prefetch(QUILT_URL, refresh=True)
+        case 'Carpet 1.12':
+            prefetch(CARPET_112)
 
     # MINECRAFT VERSION
-    def get_last_release() -> str:
-        http = urllib3.PoolManager()
-        resp: urllib3.response.HTTPResponse = http.request('GET', MOJANG_VERSIONS_MANIFEST)
-        return json.loads(resp.data.decode('utf-8'))['latest']['release']
-
-    mc_version: str = re.sub(r'[^\d.]', '', input('→ Which minecraft version do you want to use? [latest]: ').strip())
+    while True:
+        mc_version: str = ask('→ Which minecraft version do you want to use? [latest]: ', args.mc).strip()
+        if not mc_version or MC_VERSION_PATTERN.fullmatch(mc_version):
+            break
+        print(f'{mc_version} is an invalid version, something like 1.19.2 is needed')
     mc_version = mc_version if mc_version else get_last_release()
+    globals()['MC_VERSION'] = parse_version(mc_version)
     # LOGIC OF THE SCRIPT
-    mk_folder(server_folder)
     match is_mcdr:
         case True:
-            mcdr_setup(loader, mc_version, is_forge)
+            mcdr_setup(loader, mc_version, is_forge, args.nickname)
         case False:
             loader_setup(loader, mc_version)
-    post_setup(is_mcdr, mc_version, is_forge)
+    post_setup(is_mcdr, is_forge, args.eula)
+
+
+def abort() -> int:
+    print('\n!! Setup cancelled, stopping background work')
+    ABORT.set()
+    for process in list(BACKGROUND):
+        process.terminate()
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    if SERVER_FOLDER:
+        os.chdir(os.path.dirname(SERVER_FOLDER))
+        try:
+            # Only succeeds while empty, a half done setup is left for the user to inspect
+            os.rmdir(SERVER_FOLDER)
+        except OSError:
+            pass
+    return 1
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    try:
+        sys.exit(main(parse_args()))
+    except (KeyboardInterrupt, EOFError):
+        sys.exit(abort())